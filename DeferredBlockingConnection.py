@@ -1,6 +1,9 @@
 import pika
 import threading
 import datetime
+import heapq
+import itertools
+import traceback
 
 __author__ = "Adam Preble"
 __copyright__ = "Copyright 2016, Adam Preble"
@@ -16,29 +19,41 @@ Extension of pika's BlockingConnection to provide a blocking opportunity for out
 operations for it to process. In this way, it is made thread-safe in a basic way. It uses the promises pattern to
 handled deferred execution of the activities the other threads need run. The connection uses a queue that it will
 process outside of its critical section in order to keep communication operations properly-synchronized.
+
+The queue is priority-ordered. Control traffic (go/stop/ready) is scheduled with CONTROL_PRIORITY so it runs ahead of
+anything queued with BULK_PRIORITY. The same values are used as RabbitMQ message priorities, so higher runs sooner.
 '''
 
+BULK_PRIORITY = 0
+CONTROL_PRIORITY = 9
+MAX_PRIORITY = CONTROL_PRIORITY
+
 
 class Promise(object):
     """
     A contract with the DeferredBlockingConnection to execute the given callback command when it is safe to do so.
     This will store the function to call. Provide it as a function taking no arguments--lambdas are good for this.
     If there was an exception running the command, the exception property will be set to something other than None.
+    If nothing is waiting on the promise, the exception is also printed so it does not go unnoticed.
     When it is necessary to have the callback run before the thread proceeds, using wait_until_run() to block until
     the callback was completed. It will throw any exception encountered along the way.
 
     Also, you can check the retval property for any return values.
     """
 
-    def __init__(self, callback):
+    def __init__(self, callback, priority=BULK_PRIORITY):
         """
         Creates a new promise based on the given callback.
         :param callback: A function taking no arguments allowed to return what it wants. Use lambdas to massage your
         callback to fit this pattern.
+        :param priority: How urgently the callback should run. Higher priorities run first. The default is
+        BULK_PRIORITY.
         :return: (constructor)
         """
         self.callback = callback
+        self.priority = priority
         self.callback_ran = False
+        self.waited_on = False
         self.callback_condition = threading.Condition()
         self.exception = None
         self.retval = None
@@ -114,29 +129,80 @@ class DeferredBlockingChannel(pika.adapters.blocking_connection.BlockingChannel)
     """
     Subclass of pika.BlockingChannel that introduces a blocking queue. Participants from other threads can enqueue
     operations to run on this thread, which will be accomplished using Promise objects. This connection will complete
-    these commands when it isn't otherwise running internal connection operations.
+    these commands when it isn't otherwise running internal connection operations. Queued commands run in priority
+    order, so control callbacks overtake bulk ones that were queued earlier.
     """
 
     def __init__(self, channel_impl, connection):
         pika.adapters.blocking_connection.BlockingChannel.__init__(self, channel_impl, connection)
         self.callback_queue = []
         self.callback_queue_lock = threading.Lock()
+        self.callback_sequence = itertools.count()
+
+    def defer(self, callback, priority=BULK_PRIORITY):
+        """
+        Schedules a callback to be run at a thread-safe interval within this channel without waiting for it. Callbacks
+        with the same priority run in the order they were scheduled.
+        :param callback: The callback to execute.
+        :param priority: How urgently the callback should run. Higher priorities run first. The default is
+        BULK_PRIORITY.
+        :return: The Promise for the callback.
+        """
+        return self._schedule(Promise(callback, priority))
 
-    def async_exec(self, callback, timeout=3):
+    def async_exec(self, callback, timeout=3, priority=BULK_PRIORITY):
         """
         Schedules a callback to be run at a thread-safe interval within this channel. From the perspective of the
         caller, this is an asynchronous operation, even if it's perfectly-synchronous internally. Use this to utilize
         this channel from outside of the thread that owns it.
         :param callback: The callback to execute.
         :param timeout: The amount of time in seconds to wait for the command to complete.
+        :param priority: How urgently the callback should run. Higher priorities run first. The default is
+        BULK_PRIORITY.
         :return: The return value from the callback, if there was one. Otherwise, it returns None.
         """
-        promise = Promise(callback)
-        with self.callback_queue_lock:
-            self.callback_queue.append(promise)
+        promise = Promise(callback, priority)
+        promise.waited_on = True
+        self._schedule(promise)
         promise.wait_until_run(timeout)
         return promise.retval
 
+    def _schedule(self, promise):
+        """
+        Adds a promise to the priority-ordered callback queue.
+        :param promise: The Promise to run.
+        :return: The promise.
+        """
+        with self.callback_queue_lock:
+            heapq.heappush(self.callback_queue, (-promise.priority, next(self.callback_sequence), promise))
+        return promise
+
+    def _run_pending(self):
+        """
+        Runs the callbacks that were queued when this was called, highest priority first. The lock is only held to pop
+        each callback, so callbacks may schedule more work. Anything scheduled during the drain waits for the next one
+        unless it outranks what is left, which keeps bulk traffic from starving the connection's I/O. A callback that
+        raises still counts as run, so a waiter wakes up straight away to receive the exception.
+        :return: (nothing)
+        """
+        with self.callback_queue_lock:
+            pending = len(self.callback_queue)
+
+        for _ in range(pending):
+            with self.callback_queue_lock:
+                if len(self.callback_queue) == 0:
+                    return
+                promise = heapq.heappop(self.callback_queue)[2]
+            try:
+                promise.retval = promise.callback()
+            except Exception as pass_forward:
+                promise.exception = pass_forward
+                if not promise.waited_on:
+                    traceback.print_exc()
+            with promise.callback_condition:
+                promise.callback_ran = True
+                promise.callback_condition.notify()
+
     def start_consuming(self):
         """Overrides BlockingChannel.start_consuming. At time of override,
         it was documented as such:
@@ -166,17 +232,7 @@ class DeferredBlockingChannel(pika.adapters.blocking_connection.BlockingChannel)
 
         # Process events as long as consumers exist on this channel
         while self._consumer_infos:
-            with self.callback_queue_lock:
-                for promise in self.callback_queue:
-                    try:
-                        promise.retval = promise.callback()
-                        with promise.callback_condition:
-                            promise.callback_ran = True
-                            promise.callback_condition.notify()
-                    except Exception as pass_forward:
-                        promise.exception = pass_forward
-
-                self.callback_queue = []
+            self._run_pending()
 
             if self.connection.is_open:
                 self.connection.process_data_events(time_limit=0)
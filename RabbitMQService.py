@@ -2,6 +2,8 @@ import pika
 import threading
 from DeferredBlockingConnection import DeferredBlockingConnection
 from DeferredBlockingConnection import close_connection_suppressed
+from DeferredBlockingConnection import BULK_PRIORITY, CONTROL_PRIORITY, MAX_PRIORITY
+import traffic_capture
 
 __author__ = "Adam Preble"
 __copyright__ = "Copyright 2016, Adam Preble"
@@ -15,9 +17,26 @@ __status__ = "Demonstration"
 '''
 Consolidated helper for handling the gather-scatter demonstration. Various agents subclass RabbitMQService to get the
 basic handshaking under control. They then just implement inbound_message and when_starting as they see fit. They
-should use async_exec on the channel to schedule new messages.
+should use publish to send messages, and async_exec on the channel to schedule them from other threads.
+
+Messages travel in two lanes. Control messages (see message_priority) are published with a higher RabbitMQ priority into
+priority queues, and inbound control messages are handled ahead of bulk ones that are still waiting on the channel.
+This keeps the go signal from queueing behind identify messages and other chatter when a service is busy.
 '''
 
+CONTROL_MESSAGES = ("go", "stop", "ready", "workload ready", "workload completed")
+
+
+def message_priority(body_txt):
+    """
+    Classifies a message body into its lane.
+    :param body_txt: The body of the message, as a string.
+    :return: CONTROL_PRIORITY for the go/stop/ready handshake messages, otherwise BULK_PRIORITY.
+    """
+    if body_txt in CONTROL_MESSAGES or body_txt.startswith("agent ready "):
+        return CONTROL_PRIORITY
+    return BULK_PRIORITY
+
 
 class RabbitMQService(object):
     """
@@ -26,12 +45,17 @@ class RabbitMQService(object):
     inbound_message: When a new message comes in.
     when_starting: A callback when the service is starting up.
     when_stopping: A callback when the service is shutting down.
+    publish: Sends a message out on the exchange, recording it if capture is enabled.
 
     Important fields:
     self.channel: The pika channel to use. Use the async_exec call to schedule communication on it--notable outbound
     messages that needs to go through RabbitMQ.
     self.exchange_name: The name of the exchange to use.
+    self.recorder: The TrafficRecorder capturing messages, or None if capture is not enabled.
+    self.prefetch_count: How many unhandled messages RabbitMQ may hand this service at once. Anything beyond this waits
+    in the broker's priority queue, where control messages can still overtake it.
     """
+    prefetch_count = 16
 
     def __init__(self, exchange_name="gather_scatter"):
         """
@@ -43,10 +67,36 @@ class RabbitMQService(object):
         self.channel = None
         self.connection = None
         self.exchange_name = exchange_name
+        self.recorder = None
+
+    def enable_capture(self, path):
+        """
+        Records every inbound and outbound message into a binary capture log that can be replayed later using
+        traffic_capture.replay. Call this before start().
+        :param path: Path of the capture log to write. An existing file is overwritten.
+        :return: (nothing)
+        """
+        self.recorder = traffic_capture.TrafficRecorder(path)
+
+    def publish(self, routing_key, body):
+        """
+        Publishes a message to this service's exchange with the priority of its lane. This must be run on the service
+        thread, so use it inside self.channel.async_exec() when calling from elsewhere.
+        :param routing_key: The routing key for the message.
+        :param body: The body of the message.
+        :return: (nothing)
+        """
+        if self.recorder is not None:
+            self.recorder.record(traffic_capture.OUTBOUND, routing_key, body)
+        properties = pika.BasicProperties(priority=message_priority(body))
+        self.channel.basic_publish(exchange=self.exchange_name, routing_key=routing_key, body=body,
+                                   properties=properties)
 
     def _inbound_callback(self, ch, method, properties, body):
         """
-        Callback for inbound messages. This is a pass-through for the callback to pika's channel.basic_consume.
+        Callback for inbound messages from pika's channel.basic_consume. The message is handed to inbound_message
+        through the channel's priority-ordered queue, so control messages run before bulk messages received with them.
+        It is acknowledged once handled, which is what lets the broker hold back and reorder the rest.
         :param ch: The inbound channel.
         :param method: The RabbitMQ delivery method used, as interpreted by pika.
         :param properties: The RabbitMQ message properties, as interpreted by pika.
@@ -54,7 +104,31 @@ class RabbitMQService(object):
         :return: (nothing)
         """
         body_txt = body.decode("utf-8")
-        self.inbound_message(body_txt)
+        self.channel.defer(lambda: self._handle_inbound(method.delivery_tag, method.routing_key, body_txt),
+                           message_priority(body_txt))
+
+    def _handle_inbound(self, delivery_tag, routing_key, body_txt):
+        """
+        Runs inbound_message for a deferred inbound message and then acknowledges it. The message is acknowledged even
+        if inbound_message raises; the channel's drain reports the exception. Messages still queued after the service
+        stopped consuming or closed its connection are dropped, since there is nothing left to answer them on.
+        The message is captured here rather than on arrival so a capture log replays in the order it was handled.
+        :param delivery_tag: The RabbitMQ delivery tag of the message.
+        :param routing_key: The routing key the message was received with.
+        :param body_txt: The body of the message, as a UTF-8 string.
+        :return: (nothing)
+        """
+        if not self.channel.is_open or not self.channel.consumer_tags:
+            return
+
+        if self.recorder is not None:
+            self.recorder.record(traffic_capture.INBOUND, routing_key, body_txt)
+
+        try:
+            self.inbound_message(body_txt)
+        finally:
+            if self.channel.is_open:
+                self.channel.basic_ack(delivery_tag=delivery_tag)
 
     def inbound_message(self, message):
         """
@@ -91,6 +165,9 @@ class RabbitMQService(object):
 
         self.when_stopping()
 
+        if self.recorder is not None:
+            self.recorder.close()
+
     def start(self):
         """
         Starts the thread that runs this service. This will initiate communications.
@@ -101,11 +178,12 @@ class RabbitMQService(object):
 
         self.channel.exchange_declare(exchange=self.exchange_name, type='topic')
 
-        result = self.channel.queue_declare(exclusive=True)
+        result = self.channel.queue_declare(exclusive=True, arguments={"x-max-priority": MAX_PRIORITY})
         queue_name = result.method.queue
 
         self.channel.queue_bind(exchange=self.exchange_name, queue=queue_name, routing_key='*')
-        self.channel.basic_consume(self._inbound_callback, queue=queue_name, no_ack=True)
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        self.channel.basic_consume(self._inbound_callback, queue=queue_name)
 
         self.when_starting()
 
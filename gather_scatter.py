@@ -1,4 +1,5 @@
 from RabbitMQService import RabbitMQService
+from RabbitMQService import CONTROL_PRIORITY
 import agent_whitelist
 import threading
 import time
@@ -43,7 +44,7 @@ class Workload(RabbitMQService):
         self.go_signal = threading.Condition()
 
     def when_starting(self):
-        self.channel.basic_publish(exchange=self.exchange_name, routing_key='workload', body="workload ready")
+        self.publish('workload', "workload ready")
 
     def inbound_message(self, body_txt):
         if body_txt == "go":
@@ -71,7 +72,8 @@ class Workload(RabbitMQService):
         they can stop running.
         """
         print("Workload is issuing stop signal")
-        self.channel.async_exec(lambda: self.channel.basic_publish(exchange=self.exchange_name, routing_key='workload', body="workload completed"))
+        self.channel.async_exec(lambda: self.publish('workload', "workload completed"),
+                                priority=CONTROL_PRIORITY)
         print("Workload issued stop signal")
 
 
@@ -107,12 +109,12 @@ class Gatherer(RabbitMQService):
         print("Gatherer: received %s" % body_txt)
         if body_txt == "workload ready":
             self.workload_ready = True
-            self.channel.basic_publish(exchange=self.exchange_name, routing_key='gatherer', body="ready")
+            self.publish('gatherer', "ready")
 
         elif body_txt == "workload completed":
             self.workload_ready = False
             print("Gatherer propagating stop signal to monitors")
-            self.channel.basic_publish(exchange=self.exchange_name, routing_key='gatherer', body="stop")
+            self.publish('gatherer', "stop")
 
         elif body_txt.startswith("agent ready"):
             ready_agent = body_txt[12:]
@@ -128,7 +130,7 @@ class Gatherer(RabbitMQService):
 
         if self.monitor_records.all_reported() and self.workload_ready and not self.sent_go:
             print("Gatherer propagating go signal to all receivers")
-            self.channel.basic_publish(exchange=self.exchange_name, routing_key='gatherer', body="go")
+            self.publish('gatherer', "go")
             self.sent_go = True
 
 
@@ -148,7 +150,8 @@ class WorkloadMonitor(RabbitMQService):
             print("Monitor %s already stated that it was ready" % self.name)
         else:
             print("Monitor %s is responding that it's ready" % self.name)
-            self.channel.async_exec(lambda: self.channel.basic_publish(exchange=self.exchange_name, routing_key='gatherer', body="agent ready %s" % self.name))
+            # This also runs on the service thread when "ready" comes in, so it must not block waiting on the channel.
+            self.channel.defer(lambda: self.publish('gatherer', "agent ready %s" % self.name), CONTROL_PRIORITY)
             self.sent_ready = True
 
     def alert_monitor_ready(self):
@@ -170,7 +173,7 @@ class WorkloadMonitor(RabbitMQService):
             raise Exception("Monitor did not receive go signal before timeout period")
 
     def when_starting(self):
-        self.channel.basic_publish(exchange=self.exchange_name, routing_key='gatherer', body="identify %s" % self.name)
+        self.publish('gatherer', "identify %s" % self.name)
 
     def inbound_message(self, body_txt):
         print("Monitor %s received message: %s" % (self.name, body_txt))
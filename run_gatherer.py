@@ -1,13 +1,19 @@
 from gather_scatter import Gatherer
 import argparse
+import signal
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Starts the Gatherer service.')
     parser.add_argument('agents', metavar='AGENT', type=str, nargs='*',
                     help='Agents to specifically wait for ready signal')
+    parser.add_argument('--capture', dest='capture', metavar='FILE',
+                        help='Record all traffic seen by the gatherer into a capture log for run_replay')
     args = parser.parse_args()
 
     gatherer = Gatherer(args.agents)
+    if args.capture is not None:
+        print("Gatherer is capturing traffic to %s" % args.capture)
+        gatherer.enable_capture(args.capture)
     if len(args.agents) > 0:
         print("Gatherer will wait for the following agents:")
         print(", ".join(args.agents))
@@ -16,3 +22,12 @@ if __name__ == "__main__":
         print("If any connect before the workload, they'll just happen to get notified.")
     print("Starting gatherer")
     gatherer.start()
+
+    # Treat SIGTERM like Ctrl-C so either one shuts the gatherer down cleanly and closes any capture log.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while gatherer.thread.is_alive():
+            gatherer.thread.join(1)
+    except KeyboardInterrupt:
+        print("Stopping gatherer")
+        gatherer.stop()
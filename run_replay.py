@@ -0,0 +1,56 @@
+from gather_scatter import Gatherer
+import traffic_capture
+import argparse
+
+
+def positive_speed(text):
+    speed = float(text)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive, not %s" % text)
+    return speed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replays a capture log into a local Gatherer and profiles it.')
+    parser.add_argument('capture', metavar='FILE', type=str,
+                        help='Capture log recorded with run_gatherer --capture')
+    parser.add_argument('agents', metavar='AGENT', type=str, nargs='*',
+                        help='Agents the gatherer should wait for ready signal')
+    parser.add_argument('--speed', dest='speed', type=positive_speed, default=1.0,
+                        help='Replay speed multiplier. The default of 1.0 replays in real time.')
+    parser.add_argument('--max', dest='max_speed', action='store_true',
+                        help='Replay as fast as possible, ignoring the recorded timing')
+    args = parser.parse_args()
+
+    records = traffic_capture.read_capture(args.capture)
+    speed = None if args.max_speed else args.speed
+
+    gatherer = Gatherer(args.agents)
+    results = traffic_capture.replay(gatherer, records, speed)
+
+    print()
+    print("=================================")
+    print("Replay report")
+    print("=================================")
+    print()
+
+    go_decisions = 0
+    for index, result in enumerate(results):
+        bodies = result.published_bodies()
+        print("%5d %10.1f us  %-30s -> %s" % (index, result.elapsed_s * 1e6, result.record.body_text(),
+                                             ", ".join(bodies)))
+        if "go" in bodies:
+            go_decisions += 1
+
+    recorded_go = len([record for record in records
+                       if record.direction == traffic_capture.OUTBOUND and record.body_text() == "go"])
+
+    if len(results) > 0:
+        costs = [result.elapsed_s for result in results]
+        print()
+        print("Messages replayed: %d" % len(results))
+        print("Handling cost: total %.1f us, mean %.1f us, max %.1f us" %
+              (sum(costs) * 1e6, sum(costs) / len(costs) * 1e6, max(costs) * 1e6))
+    else:
+        print("No inbound messages were found in the capture.")
+    print("Go decisions during replay: %d (recorded: %d)" % (go_decisions, recorded_go))
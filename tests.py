@@ -1,4 +1,17 @@
 from agent_whitelist import AgentWhitelist
+from gather_scatter import Gatherer
+from RabbitMQService import RabbitMQService
+from RabbitMQService import message_priority
+from DeferredBlockingConnection import DeferredBlockingChannel
+from DeferredBlockingConnection import BULK_PRIORITY, CONTROL_PRIORITY
+import traffic_capture
+import io
+import itertools
+import os
+import sys
+import threading
+import tempfile
+import time
 import unittest
 
 
@@ -24,5 +37,295 @@ class WhitelistTests(unittest.TestCase):
         self.assertTrue(whitelist.all_reported())
 
 
+class CaptureTests(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_round_trip(self):
+        recorder = traffic_capture.TrafficRecorder(self.path)
+        recorder.record(traffic_capture.INBOUND, "workload", b"workload ready")
+        recorder.record(traffic_capture.OUTBOUND, "gatherer", "go")
+        recorder.close()
+
+        records = traffic_capture.read_capture(self.path)
+        self.assertEqual(2, len(records))
+        self.assertEqual(traffic_capture.INBOUND, records[0].direction)
+        self.assertEqual("workload", records[0].routing_key)
+        self.assertEqual("workload ready", records[0].body_text())
+        self.assertEqual(traffic_capture.OUTBOUND, records[1].direction)
+        self.assertEqual("go", records[1].body_text())
+        self.assertLessEqual(records[0].timestamp, records[1].timestamp)
+
+    def test_readable_before_close(self):
+        recorder = traffic_capture.TrafficRecorder(self.path)
+        recorder.record(traffic_capture.INBOUND, "workload", b"workload ready")
+        records = traffic_capture.read_capture(self.path)
+        recorder.close()
+        self.assertEqual(1, len(records))
+        self.assertEqual("workload ready", records[0].body_text())
+
+    def test_truncated(self):
+        recorder = traffic_capture.TrafficRecorder(self.path)
+        recorder.record(traffic_capture.INBOUND, "gatherer", b"identify agent1")
+        recorder.record(traffic_capture.INBOUND, "workload", b"workload ready")
+        recorder.close()
+        with open(self.path, "rb+") as capture:
+            capture.truncate(os.path.getsize(self.path) - 1)
+        records = traffic_capture.read_capture(self.path)
+        self.assertEqual(["identify agent1"], [record.body_text() for record in records])
+
+    def test_not_a_capture(self):
+        with open(self.path, "wb") as capture:
+            capture.write(b"something else")
+        self.assertRaises(ValueError, traffic_capture.read_capture, self.path)
+
+    @staticmethod
+    def inbound(timestamp, routing_key, body):
+        return traffic_capture.CaptureRecord(timestamp, traffic_capture.INBOUND, routing_key, body)
+
+    def test_replay_gatherer_waits_for_agent(self):
+        records = [self.inbound(100.0, "gatherer", b"identify agent1"),
+                   self.inbound(100.1, "workload", b"workload ready"),
+                   traffic_capture.CaptureRecord(100.2, traffic_capture.OUTBOUND, "gatherer", b"ready"),
+                   self.inbound(100.3, "gatherer", b"agent ready agent1")]
+        results = traffic_capture.replay(Gatherer(["agent1"]), records, None)
+        self.assertEqual(3, len(results))
+        self.assertEqual([], results[0].published_bodies())
+        self.assertEqual(["ready"], results[1].published_bodies())
+        self.assertEqual([("gatherer", "go")], results[2].published)
+
+    def test_replay_gatherer_waits_for_workload(self):
+        records = [self.inbound(100.0, "gatherer", b"agent ready agent1"),
+                   self.inbound(100.1, "workload", b"workload ready"),
+                   self.inbound(100.2, "workload", b"workload ready")]
+        results = traffic_capture.replay(Gatherer(["agent1"]), records, None)
+        self.assertEqual([], results[0].published_bodies())
+        self.assertEqual(["ready", "go"], results[1].published_bodies())
+        self.assertEqual(["ready"], results[2].published_bodies())
+
+    def test_replay_captures_outbound(self):
+        gatherer = Gatherer(["agent1"])
+        gatherer.enable_capture(self.path)
+        traffic_capture.replay(gatherer, [self.inbound(100.0, "workload", b"workload ready"),
+                                          self.inbound(100.1, "gatherer", b"agent ready agent1")], None)
+        gatherer.recorder.close()
+        outbound = [record.body_text() for record in traffic_capture.read_capture(self.path)
+                    if record.direction == traffic_capture.OUTBOUND]
+        self.assertEqual(["ready", "go"], outbound)
+
+    def test_replay_rejects_bad_speed(self):
+        self.assertRaises(ValueError, traffic_capture.replay, Gatherer(), [], 0)
+        self.assertRaises(ValueError, traffic_capture.replay, Gatherer(), [], -2.0)
+
+
+def capture_output(callback):
+    """
+    Runs the callback with stdout and stderr redirected, returning what was written to them.
+    """
+    output = io.StringIO()
+    old_stdout, old_stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = output, output
+    try:
+        callback()
+    finally:
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+    return output.getvalue()
+
+
+class AckChannel(object):
+    """
+    Records acknowledgements in place of a pika channel.
+    """
+    def __init__(self):
+        self.is_open = True
+        self.consumer_tags = ["ctag"]
+        self.acked = []
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+
+class ConsumingChannel(DeferredBlockingChannel):
+    """
+    A DeferredBlockingChannel that looks open and consuming, and ignores acknowledgements.
+    """
+    is_open = True
+    consumer_tags = ["ctag"]
+
+    def basic_ack(self, delivery_tag):
+        pass
+
+
+class CountingService(RabbitMQService):
+    def __init__(self):
+        RabbitMQService.__init__(self)
+        self.received = []
+
+    def inbound_message(self, message):
+        self.received.append(message)
+
+
+class FailingService(RabbitMQService):
+    def inbound_message(self, message):
+        raise RuntimeError("broken state machine")
+
+
+class InboundTests(unittest.TestCase):
+    def test_inbound_exception_acked(self):
+        service = FailingService()
+        service.channel = AckChannel()
+        self.assertRaises(RuntimeError, service._handle_inbound, 7, "gatherer", "go")
+        self.assertEqual([7], service.channel.acked)
+
+    def test_inbound_dropped_after_close(self):
+        service = CountingService()
+        service.channel = AckChannel()
+        service.channel.is_open = False
+        service._handle_inbound(7, "gatherer", "go")
+        self.assertEqual([], service.received)
+        self.assertEqual([], service.channel.acked)
+
+    def test_inbound_dropped_after_stop_consuming(self):
+        service = CountingService()
+        service.channel = AckChannel()
+        service._handle_inbound(7, "gatherer", "stop")
+        service.channel.consumer_tags = []
+        service._handle_inbound(8, "gatherer", "identify agent1")
+        self.assertEqual(["stop"], service.received)
+        self.assertEqual([7], service.channel.acked)
+
+    def test_inbound_captured_in_handling_order(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            service = CountingService()
+            service.channel = make_channel(ConsumingChannel)
+            service.enable_capture(path)
+
+            method = type("Method", (object,), {"delivery_tag": 1, "routing_key": "gatherer"})
+            service._inbound_callback(service.channel, method, None, b"identify agent1")
+            service._inbound_callback(service.channel, method, None, b"go")
+            service.channel._run_pending()
+            service.recorder.close()
+
+            records = traffic_capture.read_capture(path)
+            self.assertEqual(["go", "identify agent1"], service.received)
+            self.assertEqual(service.received, [record.body_text() for record in records])
+            self.assertEqual(["gatherer", "gatherer"], [record.routing_key for record in records])
+        finally:
+            os.remove(path)
+
+
+def make_channel(channel_class=DeferredBlockingChannel):
+    """
+    Builds a DeferredBlockingChannel with only its callback queue set up, so the drain can run without a broker.
+    """
+    channel = channel_class.__new__(channel_class)
+    channel.callback_queue = []
+    channel.callback_queue_lock = threading.Lock()
+    channel.callback_sequence = itertools.count()
+    return channel
+
+
+class PriorityLaneTests(unittest.TestCase):
+    def test_message_priority(self):
+        for control in ["go", "stop", "ready", "agent ready agent1", "workload ready", "workload completed"]:
+            self.assertEqual(CONTROL_PRIORITY, message_priority(control))
+        for bulk in ["identify agent1", "hello", "agent readying"]:
+            self.assertEqual(BULK_PRIORITY, message_priority(bulk))
+
+    def test_higher_priority_first(self):
+        channel = make_channel()
+        ran = []
+        channel.defer(lambda: ran.append("bulk"))
+        channel.defer(lambda: ran.append("control"), CONTROL_PRIORITY)
+        channel._run_pending()
+        self.assertEqual(["control", "bulk"], ran)
+
+    def test_fifo_within_priority(self):
+        channel = make_channel()
+        ran = []
+        for index in range(5):
+            channel.defer(lambda index=index: ran.append(("bulk", index)))
+            channel.defer(lambda index=index: ran.append(("control", index)), CONTROL_PRIORITY)
+        channel._run_pending()
+        self.assertEqual([("control", index) for index in range(5)] + [("bulk", index) for index in range(5)], ran)
+
+    def test_scheduled_during_drain(self):
+        channel = make_channel()
+        ran = []
+
+        def first():
+            ran.append("first")
+            channel.defer(lambda: ran.append("late control"), CONTROL_PRIORITY)
+            channel.defer(lambda: ran.append("late bulk"))
+
+        channel.defer(first)
+        channel.defer(lambda: ran.append("second"))
+        channel._run_pending()
+        self.assertEqual(["first", "late control"], ran)
+        channel._run_pending()
+        self.assertEqual(["first", "late control", "second", "late bulk"], ran)
+
+    def test_promise_results(self):
+        channel = make_channel()
+        promise = channel.defer(lambda: 42, CONTROL_PRIORITY)
+        channel._run_pending()
+        self.assertTrue(promise.callback_ran)
+        self.assertEqual(42, promise.retval)
+
+    def test_deferred_exception_reported(self):
+        channel = make_channel()
+
+        def fail():
+            raise RuntimeError("broken state machine")
+
+        promise = channel.defer(fail)
+        output = capture_output(channel._run_pending)
+        self.assertTrue(promise.callback_ran)
+        self.assertIsInstance(promise.exception, RuntimeError)
+        self.assertIn("broken state machine", output)
+
+    def test_waiter_gets_exception_promptly(self):
+        channel = make_channel()
+        outcome = []
+
+        def fail():
+            raise RuntimeError("broken state machine")
+
+        def waiter():
+            try:
+                channel.async_exec(fail, timeout=3)
+            except RuntimeError as expected:
+                outcome.append(expected)
+
+        thread = threading.Thread(target=waiter)
+        start_time = time.time()
+        thread.start()
+        output = ""
+        while thread.is_alive():
+            output += capture_output(channel._run_pending)
+            thread.join(0.01)
+        self.assertEqual(1, len(outcome))
+        self.assertLess(time.time() - start_time, 1)
+        self.assertEqual("", output)
+
+    def test_control_runs_first_under_backlog(self):
+        # The control callback runs first however deep the bulk backlog is, so it never waits behind bulk callbacks.
+        for backlog in [1, 100, 10000]:
+            channel = make_channel()
+            ran = []
+            for index in range(backlog):
+                channel.defer(lambda: ran.append("bulk"))
+            channel.defer(lambda: ran.append("control"), CONTROL_PRIORITY)
+            channel._run_pending()
+            self.assertEqual(0, ran.index("control"))
+            self.assertEqual(backlog + 1, len(ran))
+
+
 if __name__ == '__main__':
     unittest.main()
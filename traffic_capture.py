@@ -0,0 +1,192 @@
+import struct
+import threading
+import time
+
+__author__ = "Adam Preble"
+__copyright__ = "Copyright 2016, Adam Preble"
+__credits__ = ["Adam Preble"]
+__license__ = "personal"
+__version__ = "1.0.0"
+__maintainer__ = "Adam Preble"
+__email__ = "adam.preble@gmail.com"
+__status__ = "Demonstration"
+
+'''
+Traffic capture and replay for the gather-scatter services. A RabbitMQService with capture enabled writes every inbound
+and outbound message into a compact binary log using TrafficRecorder. The log can later be read back with read_capture
+and fed into a service--normally the Gatherer--using replay. Replay swaps the service's channel for a LocalTransport so
+no RabbitMQ broker is needed, and it times each call to inbound_message so the state machine can be profiled against
+real workloads.
+
+Log layout: the MAGIC header followed by records. Each record is a RECORD_HEADER (timestamp as a double in seconds since
+the epoch, direction byte, routing key length, body length) followed by the routing key and body bytes.
+'''
+
+MAGIC = b"GSCAP\x01"
+RECORD_HEADER = struct.Struct("<dBHI")
+
+INBOUND = 0
+OUTBOUND = 1
+
+
+def _to_bytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode("utf-8")
+
+
+class CaptureRecord(object):
+    """
+    A single captured message.
+    """
+    def __init__(self, timestamp, direction, routing_key, body):
+        self.timestamp = timestamp
+        self.direction = direction
+        self.routing_key = routing_key
+        self.body = body
+
+    def body_text(self):
+        return self.body.decode("utf-8")
+
+
+class TrafficRecorder(object):
+    """
+    Appends captured messages to a binary log file. Recording is guarded by a lock since inbound messages arrive on the
+    service thread while outbound messages may be published from when_starting on the thread calling start(). Every
+    record is flushed as it is written so a service that is killed mid-storm still leaves a usable log.
+    """
+    def __init__(self, path):
+        """
+        Opens a new capture log, overwriting any existing file at the path.
+        :param path: Path of the capture log to write.
+        :return: (constructor)
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.file.flush()
+
+    def record(self, direction, routing_key, body):
+        """
+        Writes one message to the log, timestamped with the current time.
+        :param direction: INBOUND or OUTBOUND.
+        :param routing_key: The routing key the message was sent or received with.
+        :param body: The message body, as bytes or a string. Strings are encoded as UTF-8.
+        :return: (nothing)
+        """
+        key_bytes = _to_bytes(routing_key or "")
+        body_bytes = _to_bytes(body)
+        header = RECORD_HEADER.pack(time.time(), direction, len(key_bytes), len(body_bytes))
+        with self.lock:
+            if self.file is not None:
+                self.file.write(header + key_bytes + body_bytes)
+                self.file.flush()
+
+    def close(self):
+        """
+        Flushes and closes the log. Further records are dropped.
+        :return: (nothing)
+        """
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_capture(path):
+    """
+    Reads back a capture log written by TrafficRecorder. A partial record at the end of the log, left behind if the
+    service was killed while writing it, is dropped.
+    :param path: Path of the capture log.
+    :return: A list of CaptureRecord in the order they were recorded.
+    :except: ValueError if the file is not a capture log.
+    """
+    records = []
+    with open(path, "rb") as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a gather-scatter capture log" % path)
+        while True:
+            header = capture.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            timestamp, direction, key_length, body_length = RECORD_HEADER.unpack(header)
+            payload = capture.read(key_length + body_length)
+            if len(payload) < key_length + body_length:
+                break
+            records.append(CaptureRecord(timestamp, direction, payload[:key_length].decode("utf-8"),
+                                         payload[key_length:]))
+    return records
+
+
+class LocalTransport(object):
+    """
+    Stand-in for DeferredBlockingChannel used during replay. Published messages are collected instead of being sent to
+    RabbitMQ, and async_exec and defer run their callbacks immediately since everything happens on the replay thread.
+    """
+    def __init__(self):
+        self.published = []
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append((routing_key, body))
+
+    def async_exec(self, callback, timeout=3, priority=None):
+        return callback()
+
+    def defer(self, callback, priority=None):
+        callback()
+
+    def stop_consuming(self):
+        pass
+
+
+class ReplayResult(object):
+    """
+    Outcome of feeding one captured inbound message into a service during replay.
+    """
+    def __init__(self, record, elapsed_s, published):
+        self.record = record
+        self.elapsed_s = elapsed_s
+        self.published = published
+
+    def published_bodies(self):
+        return [body for routing_key, body in self.published]
+
+
+def replay(service, records, speed=1.0):
+    """
+    Feeds the inbound messages from a capture into a service's inbound_message, preserving their relative timing.
+    The service's channel is replaced with a LocalTransport, so the service does not need to be started.
+    :param service: The RabbitMQService to drive. This is normally a Gatherer.
+    :param records: CaptureRecords, as returned by read_capture. Outbound records are skipped.
+    :param speed: Replay speed multiplier. 1.0 replays in real time, 10.0 ten times faster, and None runs as fast as
+    possible.
+    :return: A list of ReplayResult, one per inbound message, in replay order.
+    :except: ValueError if the speed is not positive.
+    """
+    if speed is not None and speed <= 0:
+        raise ValueError("Replay speed must be positive, not %s" % speed)
+
+    transport = LocalTransport()
+    service.channel = transport
+
+    results = []
+    first_timestamp = None
+    start_time = time.perf_counter()
+    for record in records:
+        if record.direction != INBOUND:
+            continue
+
+        if first_timestamp is None:
+            first_timestamp = record.timestamp
+        if speed is not None:
+            delay = (record.timestamp - first_timestamp) / speed - (time.perf_counter() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+
+        published_before = len(transport.published)
+        handle_start = time.perf_counter()
+        service.inbound_message(record.body_text())
+        elapsed_s = time.perf_counter() - handle_start
+        results.append(ReplayResult(record, elapsed_s, transport.published[published_before:]))
+    return results